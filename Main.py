@@ -1,11 +1,25 @@
+import hashlib
+import importlib.util
 import logging
-import openai
+import re
+import threading
+import time
+
+import httpx
+from adrf.decorators import api_view
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect
-from rest_framework.decorators import api_view
+from googleapiclient.errors import HttpError
+from openai import AsyncOpenAI, OpenAI, OpenAIError
+from rest_framework.decorators import renderer_classes
 from rest_framework.response import Response
 from rest_framework import status
 
+from .renderers import ORJSONRenderer
 from .serializers import SendEmailSerializer
 from .gmail_client import (
     get_credentials,
@@ -18,26 +32,136 @@ from .gmail_client import (
 
 logger = logging.getLogger(__name__)
 
-# Configure OpenAI if key is available
+# Gmail calls go through sync_to_async(thread_sensitive=False) so concurrent requests
+# run them in parallel on executor threads, like the threaded worker pool the sync
+# views had. PRECONDITION: gmail_client must be safe to call from several threads at
+# once. googleapiclient/httplib2 objects are not thread-safe, so it has to build its
+# service (or at least its httplib2.Http) per thread or per call, never share one.
+# get_credentials writes token.json and stays on the default thread_sensitive=True.
+
+# Shared OpenAI clients if key is available; HTTP/2 keeps one connection hot across
+# requests. httpx needs the optional h2 package for it (raises ImportError otherwise),
+# so fall back to HTTP/1.1 keep-alive when it is not installed.
+# The async client is only used under ASGI, where every request runs on the server's
+# single event loop. Under WSGI (e.g. manage.py runserver) Django gives each async
+# view its own short-lived loop and reads streaming responses on yet another one, so
+# an async stream or pooled async connection would outlive its loop; summary_view
+# uses the sync client there instead.
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_OAI = _OAI_SYNC = None
 if getattr(settings, "OPENAI_API_KEY", None):
+    _OAI = AsyncOpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        http_client=httpx.AsyncClient(http2=_HTTP2, timeout=30),
+    )
+    _OAI_SYNC = OpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        http_client=httpx.Client(http2=_HTTP2, timeout=30),
+    )
+
+# Gmail system labels use their name as the label id; no lookup needed
+_SYSTEM_LABEL_IDS = {
+    "SPAM": "SPAM",
+    "TRASH": "TRASH",
+    "INBOX": "INBOX",
+    "STARRED": "STARRED",
+    "UNREAD": "UNREAD",
+}
+
+# Max message ids accepted by organize_labels_bulk. The modify calls are made one by
+# one (gmail_client has no batch entry point), so keep a request to a few seconds.
+BULK_LABEL_MAX_IDS = 50
+
+# Gmail label name -> id, refreshed at most every `ttl` seconds (see _get_label_map)
+_LABEL_CACHE = {"ts": 0.0, "map": {}}
+_LABEL_CACHE_LOCK = threading.Lock()
+
+
+def _get_label_map(ttl=60, force=False):
+    """Return the cached {name: id} label map, refetching from Gmail once it is stale."""
+    with _LABEL_CACHE_LOCK:
+        if not force and _LABEL_CACHE["ts"] and time.monotonic() - _LABEL_CACHE["ts"] < ttl:
+            return _LABEL_CACHE["map"]
+    # fetch outside the lock so one slow Gmail call doesn't block every other caller
+    label_map = {lab["name"]: lab["id"] for lab in list_labels()}
+    with _LABEL_CACHE_LOCK:
+        _LABEL_CACHE["map"] = label_map
+        _LABEL_CACHE["ts"] = time.monotonic()
+    return label_map
+
+
+def _resolve_label_id(label_name):
+    """Return the Gmail label id for `label_name`, creating the label if it does not exist."""
+    if label_name in _SYSTEM_LABEL_IDS:
+        return _SYSTEM_LABEL_IDS[label_name]
+    label_map = _get_label_map()
+    if label_name in label_map:
+        return label_map[label_name]
     try:
-        openai.api_key = settings.OPENAI_API_KEY
-    except Exception:
-        # If using new OpenAI client libraries, this may differ. Fall back gracefully.
-        pass
+        created = create_label(label_name)
+    except HttpError as e:
+        # 409: the label was created elsewhere (another worker, the Gmail UI) after
+        # this worker's cache was filled; refetch and use it instead of failing
+        if e.resp.status != 409:
+            raise
+        label_map = _get_label_map(force=True)
+        if label_name not in label_map:
+            raise
+        return label_map[label_name]
+    label_id = created.get("id")
+    # keep the cache consistent without another list_labels() round trip; swap in a
+    # new dict so callers still holding the old map never see it change
+    with _LABEL_CACHE_LOCK:
+        _LABEL_CACHE["map"] = {**_LABEL_CACHE["map"], label_name: label_id}
+    return label_id
+
+
+# Prompt size limits for summary_view (characters)
+SUMMARY_MAX_PER_EMAIL = 800
+SUMMARY_MAX_TOTAL = 6000
+_QUOTED_REPLY_RE = re.compile(r"^>.*$\n?", re.M)
+# Kept byte-identical across calls so provider-side prompt caching can match the prefix
+_SUMMARY_SYSTEM_PROMPT = (
+    "You are an assistant who summarizes a user's recent emails. "
+    "Summarize the main topics briefly and list any clear action items."
+)
+SUMMARY_CACHE_TIMEOUT = 600
+
+
+def _trim_snippets(snippets, max_per=SUMMARY_MAX_PER_EMAIL, max_total=SUMMARY_MAX_TOTAL):
+    """Strip quoted reply lines and cap each snippet and the combined prompt text."""
+    budget = max_total
+    trimmed = []
+    for s in snippets:
+        s = _QUOTED_REPLY_RE.sub("", s).strip()[:max_per]
+        if len(s) > budget:
+            s = s[:budget]
+        budget -= len(s)
+        trimmed.append(s)
+        if budget <= 0:
+            break
+    return trimmed
+
+
+def _gmail_error(view, e):
+    """Log an expected Gmail API failure and pass its upstream status on to the client."""
+    logger.warning("%s: gmail http %s", view, e)
+    return Response({"error": e.reason}, status=e.resp.status)
 
 
 # ------------------------
 # Auth endpoints
 # ------------------------
 @api_view(["GET"])
-def start_auth(request):
+@renderer_classes([ORJSONRenderer])
+async def start_auth(request):
     """
     Start OAuth flow (if your gmail_client.get_credentials triggers interactive auth).
     This endpoint should be used to begin auth and store token.json via your gmail_client.
     """
     try:
-        creds = get_credentials()  # your gmail_client should create/save token.json after a flow
+        # your gmail_client should create/save token.json after a flow
+        creds = await sync_to_async(get_credentials)()
         return Response({"status": "ok", "message": "Credentials obtained/stored."})
     except Exception as e:
         logger.exception("start_auth failed")
@@ -45,7 +169,8 @@ def start_auth(request):
 
 
 @api_view(["GET"])
-def oauth2callback(request):
+@renderer_classes([ORJSONRenderer])
+async def oauth2callback(request):
     """
     If your oauth flow requires a callback URL to accept auth code, keep this endpoint.
     If your get_credentials handles the flow internally, this can simply acknowledge.
@@ -58,7 +183,8 @@ def oauth2callback(request):
 # Send email
 # ------------------------
 @api_view(["POST"])
-def send_view(request):
+@renderer_classes([ORJSONRenderer])
+async def send_view(request):
     """
     POST /gmail/send/
     Body JSON: { "to": "recipient@example.com", "subject": "Subject", "body": "Hello" }
@@ -71,7 +197,9 @@ def send_view(request):
     data = serializer.validated_data
     try:
         # send_message should return a dict with info or raise on failure.
-        sent_result = send_message(data["to"], data["subject"], data["body"])
+        sent_result = await sync_to_async(send_message, thread_sensitive=False)(
+            data["to"], data["subject"], data["body"]
+        )
         # Normalize return to minimal JSON for frontend
         # If send_message returns message id: {"id": "..."}
         result = {"ok": True}
@@ -84,6 +212,8 @@ def send_view(request):
             # If it's not dict, put raw value
             result["result"] = sent_result
         return Response(result)
+    except HttpError as e:
+        return _gmail_error("send_view", e)
     except Exception as e:
         logger.exception("send_view failed")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -92,8 +222,25 @@ def send_view(request):
 # ------------------------
 # List emails
 # ------------------------
+# Fallback keys per simplified field, in order of preference
+_FROM_KEYS = ("from", "sender", "emailFrom")
+_SUBJ_KEYS = ("subject", "title", "header_subject")
+# prefer an explicit date/time field, fallback to 'date'
+_TIME_KEYS = ("time", "date", "internalDate")
+
+
+def _first(m, keys):
+    """Return the first truthy value of `keys` in message dict `m`, else None."""
+    for k in keys:
+        v = m.get(k)
+        if v:
+            return v
+    return None
+
+
 @api_view(["GET"])
-def list_view(request):
+@renderer_classes([ORJSONRenderer])
+async def list_view(request):
     """
     GET /gmail/list/?limit=5&q=optional
     Returns a JSON list of simplified messages:
@@ -118,24 +265,24 @@ def list_view(request):
         limit = 10
 
     try:
-        msgs = list_messages(query=q, max_results=limit)
-        simplified = []
-        for m in msgs:
-            simplified.append(
-                {
-                    "id": m.get("id"),
-                    "threadId": m.get("threadId"),
-                    "from": m.get("from") or m.get("sender") or m.get("emailFrom"),
-                    "to": m.get("to"),
-                    "subject": m.get("subject") or m.get("title") or m.get("header_subject"),
-                    "snippet": m.get("snippet"),
-                    # prefer an explicit date/time field, fallback to 'date'
-                    "time": m.get("time") or m.get("date") or m.get("internalDate"),
-                    # the 'body' may be long; keep a truncated version for list
-                    "body": (m.get("body") or "")[:2000],
-                }
-            )
+        msgs = await sync_to_async(list_messages, thread_sensitive=False)(query=q, max_results=limit)
+        simplified = [
+            {
+                "id": m.get("id"),
+                "threadId": m.get("threadId"),
+                "from": _first(m, _FROM_KEYS),
+                "to": m.get("to"),
+                "subject": _first(m, _SUBJ_KEYS),
+                "snippet": m.get("snippet"),
+                "time": _first(m, _TIME_KEYS),
+                # the 'body' may be long; keep a truncated version for list
+                "body": (m.get("body") or "")[:2000],
+            }
+            for m in msgs
+        ]
         return Response(simplified)
+    except HttpError as e:
+        return _gmail_error("list_view", e)
     except Exception as e:
         logger.exception("list_view failed")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -144,11 +291,76 @@ def list_view(request):
 # ------------------------
 # Summary (AI)
 # ------------------------
+def _summary_cache_key(model, msgs):
+    ids = (model, tuple(sorted(m.get("id") or "" for m in msgs)))
+    return "sum:" + hashlib.blake2b(repr(ids).encode(), digest_size=16).hexdigest()
+
+
+# Appended when a summary stream dies after the 200 headers went out, so the client
+# does not mistake a truncated (or empty) body for the whole summary
+_STREAM_FAILED_NOTE = "\n\n⚠️ Summary interrupted, please try again."
+
+
+def _delta_text(chunk):
+    return (chunk.choices[0].delta.content or "") if chunk.choices else ""
+
+
+def _finish_summary_stream(parts, error, cache_key):
+    """
+    Shared tail of both stream wrappers: cache the full text of a stream that ended
+    cleanly, or log the failure and return the note to append to the response.
+    """
+    if error is None:
+        cache.set(cache_key, "".join(parts).strip(), timeout=SUMMARY_CACHE_TIMEOUT)
+        return None
+    # headers are already sent at this point; log and end the stream
+    if isinstance(error, OpenAIError):
+        logger.warning("summary_view stream: openai %s", error)
+    else:
+        logger.error("summary_view stream failed", exc_info=error)
+    return _STREAM_FAILED_NOTE
+
+
+async def _stream_summary(stream, cache_key):
+    """Yield summary text deltas from an async OpenAI stream (ASGI)."""
+    parts, error = [], None
+    try:
+        async for chunk in stream:
+            parts.append(_delta_text(chunk))
+            yield parts[-1]
+    except Exception as e:
+        error = e
+    note = await sync_to_async(_finish_summary_stream)(parts, error, cache_key)
+    if note:
+        yield note
+
+
+def _stream_summary_sync(stream, cache_key):
+    """Sync counterpart of _stream_summary, consumed by the WSGI server thread."""
+    parts, error = [], None
+    try:
+        for chunk in stream:
+            parts.append(_delta_text(chunk))
+            yield parts[-1]
+    except Exception as e:
+        error = e
+    note = _finish_summary_stream(parts, error, cache_key)
+    if note:
+        yield note
+
+
 @api_view(["GET"])
-def summary_view(request):
+@renderer_classes([ORJSONRenderer])
+async def summary_view(request):
     """
     GET /gmail/summary/?limit=5
-    Returns {"summary": "..."} or {"snippets": [...], "summary": "..."} when OpenAI key is present.
+    Streams the summary back as text/plain while the model generates it; a summary
+    already generated for the same messages is served from the cache in one piece
+    (with an "X-Summary-Cached: 1" header). Neither of these text/plain responses
+    includes the email snippets any more: clients that read "snippets" from the old
+    JSON body only get them on the no-key path below.
+    Works under both ASGI (async OpenAI stream) and WSGI/runserver (sync stream).
+    Returns JSON {"snippets": [...], "summary": None, "warning": "..."} when no OpenAI key is set.
     """
     try:
         limit = int(request.GET.get("limit", 5))
@@ -156,41 +368,51 @@ def summary_view(request):
         limit = 5
 
     try:
-        msgs = list_messages(max_results=limit)
+        msgs = await sync_to_async(list_messages, thread_sensitive=False)(max_results=limit)
         snippets = [ (m.get("body") or m.get("snippet") or "") for m in msgs ]
 
-        if not getattr(settings, "OPENAI_API_KEY", None):
+        if _OAI is None:
             # No OpenAI key — return snippets and a helpful warning
             return Response({"snippets": snippets, "summary": None, "warning": "OPENAI_API_KEY not set in settings."})
 
+        model = getattr(settings, "OPENAI_MODEL", "gpt-3.5-turbo")
+        # Same model and message ids as a recent call: the summary cannot have changed
+        cache_key = _summary_cache_key(model, msgs)
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            resp = HttpResponse(cached, content_type="text/plain; charset=utf-8")
+            resp["X-Summary-Cached"] = "1"
+            return resp
+
         # create a prompt with the recent snippets
-        prompt = "You are an assistant who summarizes a user's recent emails. " \
-                 "Summarize the main topics briefly and list any clear action items.\n\n"
-        for i, s in enumerate(snippets, 1):
+        prompt = ""
+        for i, s in enumerate(_trim_snippets(snippets), 1):
             prompt += f"Email {i}:\n{s}\n\n"
 
-        model = getattr(settings, "OPENAI_MODEL", "gpt-3.5-turbo")
-        # Use the ChatCompletion endpoint for gpt-3.5-turbo style models
-        resp = openai.ChatCompletion.create(
+        kwargs = dict(
             model=model,
             messages=[
-                {"role": "system", "content": "Summarize emails concisely and list action items."},
+                {"role": "system", "content": _SUMMARY_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt},
             ],
             max_tokens=400,
             temperature=0.25,
+            stream=True,
         )
+        if isinstance(getattr(request, "_request", request), ASGIRequest):
+            stream = await _OAI.chat.completions.create(**kwargs)
+            body = _stream_summary(stream, cache_key)
+        else:
+            # WSGI: keep the stream off this request's throwaway event loop (see _OAI_SYNC)
+            stream = await sync_to_async(_OAI_SYNC.chat.completions.create)(**kwargs)
+            body = _stream_summary_sync(stream, cache_key)
+        return StreamingHttpResponse(body, content_type="text/plain; charset=utf-8")
 
-        # Support the usual OpenAI response structure
-        summary_text = None
-        try:
-            summary_text = resp["choices"][0]["message"]["content"].strip()
-        except Exception:
-            # fallback if API returns something else
-            summary_text = str(resp)
-
-        return Response({"snippets": snippets, "summary": summary_text})
-
+    except HttpError as e:
+        return _gmail_error("summary_view", e)
+    except OpenAIError as e:
+        logger.warning("summary_view: openai %s", e)
+        return Response({"error": str(e)}, status=status.HTTP_502_BAD_GATEWAY)
     except Exception as e:
         logger.exception("summary_view failed")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -200,7 +422,8 @@ def summary_view(request):
 # Spam and Labels (existing helpers)
 # ------------------------
 @api_view(["POST"])
-def manage_spam(request):
+@renderer_classes([ORJSONRenderer])
+async def manage_spam(request):
     """
     POST /gmail/spam/
     body: { "message_id": "...", "action": "mark_spam" / "unspam" / "unmark_spam" }
@@ -213,19 +436,29 @@ def manage_spam(request):
 
     try:
         if action == "mark_spam":
-            res = modify_message_labels(message_id, add_labels=["SPAM"])
+            res = await sync_to_async(modify_message_labels, thread_sensitive=False)(
+                message_id, add_labels=[_SYSTEM_LABEL_IDS["SPAM"]]
+            )
         elif action in ("unspam", "unmark_spam"):
-            res = modify_message_labels(message_id, remove_labels=["SPAM"])
+            # move it back to the inbox in the same call
+            res = await sync_to_async(modify_message_labels, thread_sensitive=False)(
+                message_id,
+                add_labels=[_SYSTEM_LABEL_IDS["INBOX"]],
+                remove_labels=[_SYSTEM_LABEL_IDS["SPAM"]],
+            )
         else:
             return Response({"error": "unknown action"}, status=status.HTTP_400_BAD_REQUEST)
         return Response({"ok": True, "result": res})
+    except HttpError as e:
+        return _gmail_error("manage_spam", e)
     except Exception as e:
         logger.exception("manage_spam failed")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
 @api_view(["POST"])
-def organize_labels(request):
+@renderer_classes([ORJSONRenderer])
+async def organize_labels(request):
     """
     POST /gmail/labels/
     body: { "message_id": "...", "label": "LabelName" }
@@ -237,15 +470,68 @@ def organize_labels(request):
         return Response({"error": "message_id and label required"}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        labels = list_labels()
-        label_map = {lab["name"]: lab["id"] for lab in labels}
-        if label_name not in label_map:
-            created = create_label(label_name)
-            label_id = created.get("id")
-        else:
-            label_id = label_map[label_name]
-        res = modify_message_labels(message_id, add_labels=[label_id])
+        label_id = await sync_to_async(_resolve_label_id, thread_sensitive=False)(label_name)
+        res = await sync_to_async(modify_message_labels, thread_sensitive=False)(message_id, add_labels=[label_id])
         return Response({"ok": True, "result": res})
+    except HttpError as e:
+        return _gmail_error("organize_labels", e)
     except Exception as e:
         logger.exception("organize_labels failed")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _apply_label_bulk(message_ids, label_name):
+    """
+    Resolve `label_name` once and add it to each message in turn. Every failure is
+    recorded against its id, so the caller always learns which labels were applied.
+    """
+    label_id = _resolve_label_id(label_name)
+    results, errors = {}, {}
+    for mid in message_ids:
+        try:
+            results[mid] = modify_message_labels(mid, add_labels=[label_id])
+        except HttpError as e:
+            logger.warning("organize_labels_bulk: %s failed: %s", mid, e)
+            errors[mid] = e.reason
+        except Exception as e:
+            # e.g. socket timeouts / httplib2 errors; keep going with the other ids
+            logger.warning("organize_labels_bulk: %s failed: %r", mid, e)
+            errors[mid] = str(e)
+    return results, errors
+
+
+@api_view(["POST"])
+@renderer_classes([ORJSONRenderer])
+async def organize_labels_bulk(request):
+    """
+    POST /gmail/labels/bulk/
+    body: { "message_ids": ["...", ...], "label": "LabelName" }   (at most BULK_LABEL_MAX_IDS ids)
+    Returns: { "ok": bool, "results": {id: result}, "errors": {id: "..."} }
+    """
+    body = request.data
+    message_ids = body.get("message_ids")
+    label_name = body.get("label")
+    if (
+        not message_ids
+        or not isinstance(message_ids, list)
+        or not all(isinstance(mid, str) and mid for mid in message_ids)
+        or not label_name
+    ):
+        return Response(
+            {"error": "message_ids (list of non-empty strings) and label required"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(message_ids) > BULK_LABEL_MAX_IDS:
+        return Response(
+            {"error": f"at most {BULK_LABEL_MAX_IDS} message_ids per request"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    try:
+        results, errors = await sync_to_async(_apply_label_bulk, thread_sensitive=False)(list(dict.fromkeys(message_ids)), label_name)
+        return Response({"ok": not errors, "results": results, "errors": errors})
+    except HttpError as e:
+        return _gmail_error("organize_labels_bulk", e)
+    except Exception as e:
+        logger.exception("organize_labels_bulk failed")
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -1,6 +1,13 @@
 import streamlit as st
-import requests
+import os
+import re
+import sqlite3
 import time
+import uuid
+import requests
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 from email.utils import parsedate_to_datetime
 
@@ -16,80 +23,179 @@ SEND_URL = BASE_URL + "send/"
 LIST_URL = BASE_URL + "list/"
 SUMMARY_URL = BASE_URL + "summary/"
 
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+# "send an email to <recipient> [saying <body>]"
+_SEND_RE = re.compile(r"send an email to\s+(\S+)(?:\s+saying\s+(.+))?$", re.I | re.S)
+HELP_TEXT = "⚠️ I can:\n- `List my last 3 emails`\n- `Summarize my recent emails`\n- `Send an email to someone@example.com saying Hi`"
+
+# One keep-alive session for all backend calls. The script re-executes on every
+# rerun, so keep it in cache_resource instead of opening a new connection each time.
+@st.cache_resource
+def _backend_session():
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                         max_retries=Retry(total=2, backoff_factor=0.2)))
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+_SESSION = _backend_session()
+
 # -------------------------------------------------------------------
 # Multiple chat threads
 # -------------------------------------------------------------------
-if "chats" not in st.session_state:
-    st.session_state["chats"] = {
-        "Chat 1": [
-            {"role": "assistant", "content": "Hi 👋, I’m your Gmail AI assistant.\n\nHow can I help you today?"}
-        ]
-    }
-    st.session_state["current_chat"] = "Chat 1"
+# Chat history lives in SQLite so session_state only holds the current chat name.
+# The connection is shared by every browser session, so all rows carry an owner id
+# generated once per session and every query is scoped to it. Owner ids are never
+# reused, so history is only kept as long as it can still be shown: each chat is
+# trimmed to CHAT_HISTORY_LIMIT rows, and sessions idle for CHAT_RETENTION_SECONDS
+# are deleted outright (replies include email bodies).
+CHAT_DB = os.environ.get("CHAT_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "chats.db")
+CHAT_HISTORY_LIMIT = 50
+CHAT_RETENTION_SECONDS = 24 * 3600
+
+def _prune_stale_chats(conn):
+    cutoff = time.time() - CHAT_RETENTION_SECONDS
+    conn.execute("DELETE FROM messages WHERE owner IN "
+                 "(SELECT owner FROM messages GROUP BY owner HAVING MAX(ts) < ?)", (cutoff,))
+    conn.execute("DELETE FROM chats WHERE owner NOT IN (SELECT owner FROM messages)")
+
+@st.cache_resource
+def _chat_db():
+    conn = sqlite3.connect(CHAT_DB, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS chats(owner TEXT, name TEXT, created REAL, PRIMARY KEY(owner, name))")
+    conn.execute("CREATE TABLE IF NOT EXISTS messages(owner TEXT, chat TEXT, ts REAL, role TEXT, content TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS messages_owner_chat_ts ON messages(owner, chat, ts)")
+    _prune_stale_chats(conn)
+    return conn
+
+_DB = _chat_db()
+
+if "owner" not in st.session_state:
+    st.session_state["owner"] = uuid.uuid4().hex
+    # once per new session: drop history of sessions nobody can return to
+    _prune_stale_chats(_DB)
+_OWNER = st.session_state["owner"]
+
+def add_message(role, content, chat=None):
+    chat = chat or st.session_state["current_chat"]
+    _DB.execute("INSERT INTO messages VALUES(?,?,?,?,?)", (_OWNER, chat, time.time(), role, content))
+    # only the last CHAT_HISTORY_LIMIT rows are ever rendered; don't keep the rest
+    _DB.execute(
+        "DELETE FROM messages WHERE owner=? AND chat=? AND rowid NOT IN "
+        "(SELECT rowid FROM messages WHERE owner=? AND chat=? ORDER BY ts DESC, rowid DESC LIMIT ?)",
+        (_OWNER, chat, _OWNER, chat, CHAT_HISTORY_LIMIT),
+    )
+
+def reset_chat(chat, greeting):
+    """Create `chat` (or empty it, keeping its place in the list) and post `greeting`."""
+    _DB.execute("INSERT OR IGNORE INTO chats VALUES(?,?,?)", (_OWNER, chat, time.time()))
+    _DB.execute("DELETE FROM messages WHERE owner=? AND chat=?", (_OWNER, chat))
+    add_message("assistant", greeting, chat=chat)
+
+def chat_names():
+    rows = _DB.execute("SELECT name FROM chats WHERE owner=? ORDER BY created, rowid", (_OWNER,))
+    return [row[0] for row in rows]
 
 def current_messages():
-    return st.session_state["chats"][st.session_state["current_chat"]]
+    """Last CHAT_HISTORY_LIMIT messages of the current chat, oldest first."""
+    rows = _DB.execute(
+        "SELECT role, content FROM messages WHERE owner=? AND chat=? ORDER BY ts DESC, rowid DESC LIMIT ?",
+        (_OWNER, st.session_state["current_chat"], CHAT_HISTORY_LIMIT),
+    ).fetchall()
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+# new session, or this session sat idle past the retention window and was pruned
+if st.session_state.get("current_chat") not in chat_names():
+    reset_chat("Chat 1", "Hi 👋, I’m your Gmail AI assistant.\n\nHow can I help you today?")
+    st.session_state["current_chat"] = "Chat 1"
 
 # -------------------------------------------------------------------
 # API Helpers
 # -------------------------------------------------------------------
+# Sidebar and chat reruns with the same limit share one backend response for 30s.
+# Failures raise out of the cached function so they are never cached.
+@st.cache_data(ttl=30, show_spinner=False)
+def _fetch_emails(limit):
+    resp = _SESSION.get(LIST_URL, params={"limit": limit}, timeout=10)
+    resp.raise_for_status()
+    return resp.json()
+
 def list_emails(limit=3):
     try:
-        resp = requests.get(LIST_URL, params={"limit": limit}, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
+        return _fetch_emails(limit)
     except Exception as e:
         return {"error": str(e)}
 
 def summarize_emails(limit=5):
+    """Yield the inbox summary as the backend streams it (for st.write_stream)."""
     try:
-        resp = requests.get(SUMMARY_URL, params={"limit": limit}, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
+        with _SESSION.get(SUMMARY_URL, params={"limit": limit}, stream=True, timeout=10) as resp:
+            resp.raise_for_status()
+            if resp.headers.get("Content-Type", "").startswith("application/json"):
+                # no OpenAI key on the backend: plain JSON with a warning instead of a stream
+                data = resp.json()
+                yield data.get("summary") or data.get("warning") or str(data)
+                return
+            resp.encoding = resp.encoding or "utf-8"
+            yield from resp.iter_content(chunk_size=None, decode_unicode=True)
     except Exception as e:
-        return {"error": str(e)}
+        yield f"⚠️ Failed to summarize emails: {e}"
 
 def send_email(to, subject, body):
     try:
         payload = {"to": to, "subject": subject, "body": body}
-        resp = requests.post(SEND_URL, json=payload, timeout=15)
+        resp = _SESSION.post(SEND_URL, json=payload, timeout=15)
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
         return {"error": str(e)}
 
-def format_time(raw_time):
+def _format_time(raw_time):
     """Convert Gmail RFC822 or epoch time to nice format"""
-    if not raw_time:
+    if raw_time is None or raw_time == "":
         return ""
-    try:
-        # Try parsing Gmail RFC822 date
-        dt = parsedate_to_datetime(raw_time)
-        return dt.strftime("%Y-%m-%d %H:%M")
-    except Exception:
+    s = raw_time if isinstance(raw_time, str) else str(raw_time)
+    # Epoch (ms), e.g. Gmail internalDate; out-of-range values are shown as-is
+    if isinstance(raw_time, (int, float)):
+        try:
+            return datetime.fromtimestamp(raw_time / 1000).strftime(TIME_FORMAT)
+        except (OverflowError, OSError, ValueError):
+            return s
+    if s.isdigit():
         try:
-            # Fallback if timestamp is epoch (ms)
-            if isinstance(raw_time, (int, float)) or raw_time.isdigit():
-                dt = datetime.fromtimestamp(int(raw_time) / 1000)
-                return dt.strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            pass
-    return str(raw_time)
+            return datetime.fromtimestamp(int(s) / 1000).strftime(TIME_FORMAT)
+        except (OverflowError, OSError, ValueError):
+            return s
+    # Gmail RFC822 date
+    try:
+        dt = parsedate_to_datetime(s)
+    except (TypeError, ValueError):
+        return s
+    return dt.strftime(TIME_FORMAT) if dt else s
+
+# The script re-executes on every rerun, which would start a fresh lru_cache each
+# time; keep one memo per process so a timestamp is only ever formatted once.
+@st.cache_resource
+def _time_formatter():
+    return lru_cache(maxsize=4096)(_format_time)
+
+format_time = _time_formatter()
 
 # -------------------------------------------------------------------
 # Chat display
 # -------------------------------------------------------------------
 for msg in current_messages():
-    if msg["role"] == "user":
-        st.markdown(f"<div style='margin:8px 0;'><b>You:</b><br>{msg['content']}</div>", unsafe_allow_html=True)
-    else:
-        st.markdown(f"<div style='margin:8px 0;'><b>Assistant:</b><br>{msg['content']}</div>", unsafe_allow_html=True)
+    with st.chat_message(msg["role"]):
+        st.markdown(msg["content"])
 
 # -------------------------------------------------------------------
 # Chat input
 # -------------------------------------------------------------------
 if prompt := st.chat_input("Type your Gmail request..."):
-    current_messages().append({"role": "user", "content": prompt})
+    add_message("user", prompt)
+    with st.chat_message("user"):
+        st.markdown(prompt)
     reply = None
     p = prompt.lower().strip()
 
@@ -107,43 +213,40 @@ if prompt := st.chat_input("Type your Gmail request..."):
                 reply += f"- Body: {e.get('body')}\n\n"
 
     elif "summarize" in p:
-        with st.spinner("Summarizing emails..."):
-            data = summarize_emails(limit=5)
-        if "error" in data:
-            reply = f"⚠️ Failed to summarize emails: {data['error']}"
-        else:
-            reply = "📝 **Inbox Summary:**\n\n"
-            reply += data.get("summary", str(data))
+        reply = "📝 **Inbox Summary:**\n\n"
+        with st.chat_message("assistant"):
+            st.markdown(reply)
+            reply += st.write_stream(summarize_emails(limit=5))
 
     elif "send an email to" in p:
-        try:
-            parts = prompt.split("send an email to")[1].strip().split("saying")
-            recipient = parts[0].strip()
-            body = parts[1].strip() if len(parts) > 1 else "Hello!"
-        except:
-            recipient, body = "unknown@example.com", "Hello!"
-        subject = body[:30] or "No subject"
-
-        with st.spinner("Sending email..."):
-            data = send_email(recipient, subject, body)
-        if "error" in data:
-            reply = f"⚠️ Failed to send email: {data['error']}"
+        m = _SEND_RE.search(prompt.strip())
+        if m:
+            recipient, body = m.group(1), (m.group(2) or "Hello!").strip()
         else:
-            reply = f"""✅ **Email Sent**
+            recipient, body = None, None
+
+        if recipient is None:
+            reply = HELP_TEXT
+        else:
+            subject = body[:30] or "No subject"
+            with st.spinner("Sending email..."):
+                data = send_email(recipient, subject, body)
+            if "error" in data:
+                reply = f"⚠️ Failed to send email: {data['error']}"
+            else:
+                _fetch_emails.clear()
+                reply = f"""✅ **Email Sent**
 
 - To: {recipient}  
 - Subject: {subject}  
 - Body: {body}  
-- Time: {datetime.now().strftime('%Y-%m-%d %H:%M')}  
+- Time: {datetime.now().strftime(TIME_FORMAT)}  
 """
 
     else:
-        reply = "⚠️ I can:\n- `List my last 3 emails`\n- `Summarize my recent emails`\n- `Send an email to someone@example.com saying Hi`"
-
-    with st.spinner("Assistant is typing..."):
-        time.sleep(1.2)
+        reply = HELP_TEXT
 
-    current_messages().append({"role": "assistant", "content": reply})
+    add_message("assistant", reply)
     st.rerun()
 
 # -------------------------------------------------------------------
@@ -151,33 +254,32 @@ if prompt := st.chat_input("Type your Gmail request..."):
 # -------------------------------------------------------------------
 st.sidebar.header("💬 Conversation Controls")
 
+chats = chat_names()
 if st.sidebar.button("➕ New Chat"):
-    new_name = f"Chat {len(st.session_state['chats'])+1}"
-    st.session_state["chats"][new_name] = [
-        {"role": "assistant", "content": "New chat started. Hi 👋, how can I help you?"}
-    ]
+    new_name = f"Chat {len(chats)+1}"
+    reset_chat(new_name, "New chat started. Hi 👋, how can I help you?")
     st.session_state["current_chat"] = new_name
     st.rerun()
 
-chat_choice = st.sidebar.radio("Your Chats", list(st.session_state["chats"].keys()),
-                               index=list(st.session_state["chats"].keys()).index(st.session_state["current_chat"]))
+chat_choice = st.sidebar.radio("Your Chats", chats,
+                               index=chats.index(st.session_state["current_chat"]))
 st.session_state["current_chat"] = chat_choice
 
 if st.sidebar.button("🗑️ Clear Chat"):
-    st.session_state["chats"][st.session_state["current_chat"]] = [
-        {"role": "assistant", "content": "Chat cleared. Hi 👋, how can I help you now?"}
-    ]
+    reset_chat(st.session_state["current_chat"], "Chat cleared. Hi 👋, how can I help you now?")
     st.rerun()
 
-st.sidebar.subheader("📥 Inbox")
-with st.spinner("Loading inbox..."):
-    data = list_emails(limit=5)
-if "error" in data:
-    st.sidebar.write(f"⚠️ {data['error']}")
-else:
-    for email in data:
-        with st.sidebar.expander(f"{email.get('subject')} ({email.get('from')})"):
-            st.write(f"📧 From: {email.get('from')}")
-            st.write(f"🕒 {format_time(email.get('time'))}")
-            st.write(f"📝 {email.get('body')}")
-
+# Only hit the backend when the user actually opens the inbox
+if st.sidebar.checkbox("📥 Show inbox", value=False):
+    if st.sidebar.button("🔄 Refresh inbox"):
+        _fetch_emails.clear()
+    with st.spinner("Loading inbox..."):
+        data = list_emails(limit=5)
+    if "error" in data:
+        st.sidebar.write(f"⚠️ {data['error']}")
+    else:
+        for email in data:
+            with st.sidebar.expander(f"{email.get('subject')} ({email.get('from')})"):
+                st.write(f"📧 From: {email.get('from')}")
+                st.write(f"🕒 {format_time(email.get('time'))}")
+                st.write(f"📝 {email.get('body')}")
@@ -0,0 +1,18 @@
+import orjson
+from rest_framework.renderers import BaseRenderer
+
+
+class ORJSONRenderer(BaseRenderer):
+    """
+    JSON renderer backed by orjson (faster than DRF's stdlib-json JSONRenderer
+    on large list payloads). Can also be set globally via
+    REST_FRAMEWORK["DEFAULT_RENDERER_CLASSES"].
+    """
+    media_type = "application/json"
+    format = "json"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)